@@ -1,34 +1,223 @@
 from __future__ import absolute_import
 import os
 import re
-from OpenSSL import SSL
-from netlib import http_auth, certutils, tcp
-from .. import utils, platform, version
+import stat
+import threading
+try:
+    import hyperscan
+except ImportError:  # pragma nocover
+    hyperscan = None
+from .. import utils, version
 from .primitives import RegularProxyMode, TransparentProxyMode, UpstreamProxyMode, ReverseProxyMode, Socks5ProxyMode
 
-TRANSPARENT_SSL_PORTS = [443, 8443]
+# OpenSSL, netlib.tcp and libmproxy.platform are comparatively expensive to
+# import and not needed by CLI invocations that only parse options, so they
+# are deferred to first use.
+SSL = None
+tcp = None
+
+TRANSPARENT_SSL_PORTS = (443, 8443)
 CONF_BASENAME = "mitmproxy"
 CA_DIR = "~/.mitmproxy"
 
 
+def _import_ssl():
+    global SSL
+    if SSL is None:
+        from OpenSSL import SSL
+    return SSL
+
+
+def _compile_combined(patterns):
+    """
+        Fuse a tuple of patterns into a single alternation so that one
+        search call replaces a Python-level loop over N compiled regexes.
+        Returns None if there are no patterns.
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join("(?:%s)" % p for p in patterns), re.IGNORECASE)
+_combined_pattern_cache = utils.LRUCache(32)
+_suffix_pattern = re.compile(r"^\*\.[\w.-]+$")
+
+
+class _HyperscanMatch(Exception):
+    """
+        Raised from the scan callback to stop on the first hit.
+    """
+
+
+def _hyperscan_first_match(*args):
+    raise _HyperscanMatch()
+
+
+def _compile_hyperscan(patterns):
+    """
+        Compile patterns into a Hyperscan database for single-pass
+        multi-pattern scanning. Returns None if hyperscan is not installed
+        or rejects one of the patterns, in which case the combined regex
+        is used instead.
+    """
+    if hyperscan is None or not patterns:
+        return None
+    try:
+        db = hyperscan.Database()
+        db.compile(
+            expressions=[p.encode() for p in patterns],
+            flags=[hyperscan.HS_FLAG_CASELESS] * len(patterns),
+        )
+        return db
+    except Exception:  # pragma nocover
+        return None
+_hyperscan_db_cache = utils.LRUCache(32)
+_hyperscan_scratch = threading.local()
+
+
+def _hyperscan_thread_scratch(db):
+    """
+        A database's built-in scratch must not be used by concurrent scans,
+        and connections are handled on per-connection threads. Allocate one
+        scratch per thread per database instead.
+    """
+    scratches = getattr(_hyperscan_scratch, "scratches", None)
+    if scratches is None:
+        scratches = _hyperscan_scratch.scratches = {}
+    scratch = scratches.get(id(db))
+    if scratch is None:
+        scratch = scratches[id(db)] = hyperscan.Scratch(db)
+    return scratch
+
+
 class HostMatcher(object):
-    def __init__(self, patterns=[]):
-        self.patterns = list(patterns)
-        self.regexes = [re.compile(p, re.IGNORECASE) for p in self.patterns]
+    """
+        Matches "host:port" strings against a list of patterns. Patterns are
+        partitioned at construction time so that the common cases avoid the
+        regex engine entirely:
+
+        - patterns without regex metacharacters are checked with a plain
+          substring test, preserving re.search semantics
+        - "*.example.com"-style globs are checked with endswith on the host
+        - everything else goes into a single combined regex
+    """
+    def __init__(self, patterns=None):
+        patterns = tuple(patterns or ())
+        self._patterns = patterns
+        literals, suffixes, regexes = [], [], []
+        for p in patterns:
+            if re.escape(p) == p:
+                literals.append(p.lower())
+            elif _suffix_pattern.match(p):
+                # "*.example.com" -> ".example.com"
+                suffixes.append(p[1:].lower())
+            else:
+                regexes.append(p)
+        self._literals = tuple(literals)
+        self._suffixes = tuple(suffixes)
+        self._combined = _combined_pattern_cache.get(
+            _compile_combined, tuple(regexes)
+        )
+        self._hs_db = _hyperscan_db_cache.get(
+            _compile_hyperscan, tuple(regexes)
+        )
+        # Pre-bind the search method so the per-request path doesn't pay
+        # for attribute and method lookups on every call.
+        self._search = self._combined.search if self._combined is not None else None
+        self._truthy = bool(patterns)
+
+    @property
+    def patterns(self):
+        """
+            The patterns this matcher was constructed with, in their
+            original order. Stored internally as a tuple; only the compiled
+            forms are consulted when matching.
+        """
+        return list(self._patterns)
 
     def __call__(self, address):
-        address = tcp.Address.wrap(address)
-        host = "%s:%s" % (address.host, address.port)
-        if any(rex.search(host) for rex in self.regexes):
-            return True
-        else:
+        if not self._truthy:
             return False
+        global tcp
+        if tcp is None:
+            from netlib import tcp
+        if not isinstance(address, tcp.Address):
+            address = tcp.Address.wrap(address)
+        return self.match_str("%s:%s" % (address.host, address.port))
+
+    def match_str(self, host_port):
+        """
+            Match a pre-formatted "host:port" string, skipping address
+            wrapping and formatting for callers that already hold one.
+        """
+        if self._literals or self._suffixes:
+            lower = host_port.lower()
+            for literal in self._literals:
+                if literal in lower:
+                    return True
+            if self._suffixes:
+                host = lower.rpartition(":")[0]
+                for suffix in self._suffixes:
+                    if host.endswith(suffix):
+                        return True
+        if self._hs_db is not None:
+            try:
+                self._hs_db.scan(
+                    host_port.encode(),
+                    match_event_handler=_hyperscan_first_match,
+                    scratch=_hyperscan_thread_scratch(self._hs_db),
+                )
+            except _HyperscanMatch:
+                return True
+            except Exception:  # pragma nocover
+                # Hyperscan runtime error: fall through to the combined
+                # regex rather than failing the match.
+                pass
+            else:
+                return False
+        search = self._search
+        return search is not None and search(host_port) is not None
 
-    def __nonzero__(self):
-        return bool(self.patterns)
+    def __bool__(self):
+        return self._truthy
+    # Python 2 spells __bool__ as __nonzero__.
+    __nonzero__ = __bool__
 
 
-class ProxyConfig:
+# "--cert [domain=]path" specs, parsed in a single pass; a missing domain
+# part means "*".
+_CERT_SPEC_RE = re.compile(r"^(?:([^=]+)=)?(.*)$")
+
+_resolver_cache = None
+
+
+def _cached_resolver():
+    """
+        platform.resolver() probes OS capabilities (e.g. netfilter support
+        on Linux); run the probe once per process and reuse the result.
+        The cache is keyed on the resolver callable itself, so tests that
+        patch platform.resolver are never served a stale result.
+    """
+    global _resolver_cache
+    from .. import platform
+    if _resolver_cache is None or _resolver_cache[0] is not platform.resolver:
+        _resolver_cache = (platform.resolver, platform.resolver())
+    return _resolver_cache[1]
+
+
+_certstore_lock = threading.Lock()
+
+
+class ProxyConfig(object):
+    __slots__ = (
+        "host", "port", "server_version", "server_header_bytes",
+        "ciphers_client", "ciphers_server", "clientcerts",
+        "no_upstream_cert", "body_size_limit", "mode",
+        "check_ignore", "check_tcp", "authenticator", "cadir",
+        "certforward", "ssl_ports",
+        "_certs", "_certstore",
+        "_ssl_version_client", "_ssl_version_server",
+        "_openssl_client", "_openssl_server",
+    )
+
     def __init__(
             self,
             host='',
@@ -43,11 +232,11 @@ class ProxyConfig:
             http_form_in=None,
             http_form_out=None,
             authenticator=None,
-            ignore_hosts=[],
-            tcp_hosts=[],
+            ignore_hosts=None,
+            tcp_hosts=None,
             ciphers_client=None,
             ciphers_server=None,
-            certs=[],
+            certs=None,
             certforward=False,
             ssl_version_client="secure",
             ssl_version_server="secure",
@@ -56,6 +245,9 @@ class ProxyConfig:
         self.host = host
         self.port = port
         self.server_version = server_version
+        # Precomputed header line for responses, so the egress path can
+        # splice it in without re-formatting the version on every response.
+        self.server_header_bytes = "Server: %s\r\n" % server_version
         self.ciphers_client = ciphers_client
         self.ciphers_server = ciphers_server
         self.clientcerts = clientcerts
@@ -63,7 +255,7 @@ class ProxyConfig:
         self.body_size_limit = body_size_limit
 
         if mode == "transparent":
-            self.mode = TransparentProxyMode(platform.resolver(), ssl_ports)
+            self.mode = TransparentProxyMode(_cached_resolver(), ssl_ports)
         elif mode == "socks5":
             self.mode = Socks5ProxyMode(ssl_ports)
         elif mode == "reverse":
@@ -81,17 +273,102 @@ class ProxyConfig:
         self.check_tcp = HostMatcher(tcp_hosts)
         self.authenticator = authenticator
         self.cadir = os.path.expanduser(cadir)
-        self.certstore = certutils.CertStore.from_store(self.cadir, CONF_BASENAME)
-        for spec, cert in certs:
-            self.certstore.add_cert_file(spec, cert)
+        # The certstore (disk I/O, key generation on first run) and the
+        # OpenSSL method lookups are only materialized on first access, so
+        # that constructing a config for inspection stays cheap.
+        self._certs = certs or ()
+        self._certstore = None
+        self._ssl_version_client = ssl_version_client
+        self._ssl_version_server = ssl_version_server
+        self._openssl_client = None
+        self._openssl_server = None
         self.certforward = certforward
-        self.openssl_method_client, self.openssl_options_client = version_to_openssl(ssl_version_client)
-        self.openssl_method_server, self.openssl_options_server = version_to_openssl(ssl_version_server)
         self.ssl_ports = ssl_ports
 
+    @property
+    def certstore(self):
+        # First access happens on per-connection threads; building the
+        # store hits the disk and may generate the CA on first run, so
+        # double-checked locking keeps concurrent connections from
+        # constructing (and writing) it twice.
+        if self._certstore is None:
+            with _certstore_lock:
+                if self._certstore is None:
+                    from netlib import certutils
+                    certstore = certutils.CertStore.from_store(self.cadir, CONF_BASENAME)
+                    for spec, cert in self._certs:
+                        certstore.add_cert_file(spec, cert)
+                    self._certstore = certstore
+        return self._certstore
+
+    @property
+    def openssl_method_client(self):
+        if self._openssl_client is None:
+            self._openssl_client = version_to_openssl(self._ssl_version_client)
+        return self._openssl_client[0]
+
+    @property
+    def openssl_options_client(self):
+        if self._openssl_client is None:
+            self._openssl_client = version_to_openssl(self._ssl_version_client)
+        return self._openssl_client[1]
+
+    def new_client_ctx(self):
+        """
+            Create a fresh SSL.Context for a client connection, built from
+            the cached method/options for the configured client SSL version.
+            Contexts are stateful and must not be shared across connections,
+            so a new one is returned on every call.
+        """
+        ctx = _import_ssl().Context(self.openssl_method_client)
+        if self.openssl_options_client:
+            ctx.set_options(self.openssl_options_client)
+        return ctx
+
+    def new_server_ctx(self):
+        """
+            Like new_client_ctx, for server connections.
+        """
+        ctx = _import_ssl().Context(self.openssl_method_server)
+        if self.openssl_options_server:
+            ctx.set_options(self.openssl_options_server)
+        return ctx
+
+    @property
+    def openssl_method_server(self):
+        if self._openssl_server is None:
+            self._openssl_server = version_to_openssl(self._ssl_version_server)
+        return self._openssl_server[0]
+
+    @property
+    def openssl_options_server(self):
+        if self._openssl_server is None:
+            self._openssl_server = version_to_openssl(self._ssl_version_server)
+        return self._openssl_server[1]
+
 
 sslversion_choices = ("all", "secure", "SSLv2", "SSLv3", "TLSv1", "TLSv1_1", "TLSv1_2")
 
+_VERSION_TO_OPENSSL = None
+
+
+def _version_table():
+    global _VERSION_TO_OPENSSL
+    if _VERSION_TO_OPENSSL is None:
+        SSL = _import_ssl()
+        # SSLv23_METHOD + NO_SSLv2 + NO_SSLv3 == TLS 1.0+
+        # TLSv1_METHOD would be TLS 1.0 only
+        table = {
+            "all": (SSL.SSLv23_METHOD, None),
+            "secure": (SSL.SSLv23_METHOD, SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3),
+        }
+        for v in sslversion_choices[2:]:
+            method = getattr(SSL, "%s_METHOD" % v, None)
+            if method is not None:
+                table[v] = (method, None)
+        _VERSION_TO_OPENSSL = table
+    return _VERSION_TO_OPENSSL
+
 
 def version_to_openssl(version):
     """
@@ -99,19 +376,16 @@ def version_to_openssl(version):
     Don't ask...
     https://bugs.launchpad.net/pyopenssl/+bug/1020632/comments/3
     """
-    if version == "all":
-        return SSL.SSLv23_METHOD, None
-    elif version == "secure":
-        # SSLv23_METHOD + NO_SSLv2 + NO_SSLv3 == TLS 1.0+
-        # TLSv1_METHOD would be TLS 1.0 only
-        return SSL.SSLv23_METHOD, (SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3)
-    elif version in sslversion_choices:
-        return getattr(SSL, "%s_METHOD" % version), None
-    else:
+    try:
+        return _version_table()[version]
+    except KeyError:
         raise ValueError("Invalid SSL version: %s" % version)
 
 
 def process_proxy_options(parser, options):
+    from netlib import http_auth
+    from .. import platform
+
     body_size_limit = utils.parse_size(options.body_size_limit)
 
     c = 0
@@ -138,16 +412,20 @@ def process_proxy_options(parser, options):
 
     if options.clientcerts:
         options.clientcerts = os.path.expanduser(options.clientcerts)
-        if not os.path.exists(options.clientcerts) or not os.path.isdir(options.clientcerts):
+        try:
+            st = os.stat(options.clientcerts)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISDIR(st.st_mode):
             return parser.error(
                 "Client certificate directory does not exist or is not a directory: %s" % options.clientcerts
             )
 
     if (options.auth_nonanonymous or options.auth_singleuser or options.auth_htpasswd):
         if options.auth_singleuser:
-            if len(options.auth_singleuser.split(':')) != 2:
+            username, sep, password = options.auth_singleuser.partition(':')
+            if not sep or ':' in password:
                 return parser.error("Invalid single-user specification. Please use the format username:password")
-            username, password = options.auth_singleuser.split(':')
             password_manager = http_auth.PassManSingleUser(username, password)
         elif options.auth_nonanonymous:
             password_manager = http_auth.PassManNonAnon()
@@ -162,16 +440,17 @@ def process_proxy_options(parser, options):
 
     certs = []
     for i in options.certs:
-        parts = i.split("=", 1)
-        if len(parts) == 1:
-            parts = ["*", parts[0]]
-        parts[1] = os.path.expanduser(parts[1])
-        if not os.path.exists(parts[1]):
-            parser.error("Certificate file does not exist: %s" % parts[1])
-        certs.append(parts)
+        m = _CERT_SPEC_RE.match(i)
+        spec = m.group(1) or "*"
+        path = os.path.expanduser(m.group(2))
+        try:
+            os.stat(path)
+        except OSError:
+            parser.error("Certificate file does not exist: %s" % path)
+        certs.append((spec, path))
 
     ssl_ports = options.ssl_ports
-    if options.ssl_ports != TRANSPARENT_SSL_PORTS:
+    if len(ssl_ports) > len(TRANSPARENT_SSL_PORTS):
         # arparse appends to default value by default, strip that off.
         # see http://bugs.python.org/issue16399
         ssl_ports = ssl_ports[len(TRANSPARENT_SSL_PORTS):]
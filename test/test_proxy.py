@@ -1,6 +1,7 @@
 import argparse
 from libmproxy import cmdline
 from libmproxy.proxy import ProxyConfig, process_proxy_options
+from libmproxy.proxy.config import HostMatcher
 from libmproxy.proxy.connection import ServerConnection
 from libmproxy.proxy.primitives import ProxyError
 from libmproxy.proxy.server import DummyServer, ProxyServer, ConnectionHandler
@@ -15,6 +16,51 @@ def test_proxy_error():
     assert str(p)
 
 
+class TestHostMatcher:
+    def test_empty(self):
+        m = HostMatcher()
+        assert not m
+        assert not m(("example.com", 80))
+        assert m.patterns == []
+
+    def test_bool(self):
+        assert HostMatcher(["example.com"]).__bool__()
+        assert not HostMatcher().__bool__()
+
+    def test_literal(self):
+        m = HostMatcher(["localhost"])
+        assert m(("localhost", 8080))
+        # substring semantics, like re.search on a literal pattern
+        assert m(("api.localhost.org", 80))
+        assert m(("LOCALHOST", 80))
+        assert not m(("goodhost", 80))
+
+    def test_suffix_glob(self):
+        m = HostMatcher(["*.example.com"])
+        assert m(("www.example.com", 443))
+        assert m(("a.b.EXAMPLE.com", 80))
+        assert not m(("example.com", 443))
+        assert not m(("notexample.com", 443))
+
+    def test_regex(self):
+        m = HostMatcher([".+:8080"])
+        assert m(("foo", 8080))
+        assert not m(("foo", 80))
+
+    def test_mixed(self):
+        m = HostMatcher(["localhost", "*.example.com", ".+:8080"])
+        assert m(("localhost", 1))
+        assert m(("sub.example.com", 443))
+        assert m(("anything", 8080))
+        assert not m(("other.org", 80))
+        assert m.patterns == ["localhost", "*.example.com", ".+:8080"]
+
+    def test_match_str(self):
+        m = HostMatcher(["example\\.com:443"])
+        assert m.match_str("example.com:443")
+        assert not m.match_str("example.com:80")
+
+
 class TestServerConnection:
     def setUp(self):
         self.d = test.Daemon()